@@ -11,15 +11,21 @@ from flask_wtf import CSRFProtect, FlaskForm
 from flask_wtf.csrf import generate_csrf
 from wtforms import StringField, SubmitField, DecimalField, IntegerField
 from wtforms.validators import DataRequired, Email, Length, Optional, NumberRange
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import VerifyMismatchError, InvalidHashError
 from functools import wraps
-from sqlalchemy import event
+from sqlalchemy import event, insert, update, select, bindparam, func
 from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import selectinload, joinedload
 
 # ----- Extensiones -----
 db = SQLAlchemy()
 login_manager = LoginManager()
 csrf = CSRFProtect()
+# Argon2id ajustado a ~100 ms por verificación
+ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=2)
 
 
 @event.listens_for(Engine, "connect")
@@ -27,11 +33,33 @@ def set_sqlite_pragma(dbapi_connection, connection_record):
     try:
         cursor = dbapi_connection.cursor()
         cursor.execute("PRAGMA foreign_keys=ON;")
+        # WAL: lectores no bloquean al escritor; el commit agrega un frame en vez de hacer fsync completo
+        cursor.execute("PRAGMA journal_mode=WAL;")
+        cursor.execute("PRAGMA synchronous=NORMAL;")
+        cursor.execute("PRAGMA temp_store=MEMORY;")
+        cursor.execute("PRAGMA cache_size=-20000;")
+        cursor.execute("PRAGMA mmap_size=268435456;")
         cursor.close()
     except Exception:
         pass
 
 
+# ----- Permisos por rol -----
+def roles_required(*roles):
+    """Permite acceder solo si el rol del usuario está en roles; si no, 403."""
+    roles = frozenset(roles)
+
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            u = current_user._get_current_object()
+            if not u.is_authenticated or u.role not in roles:
+                abort(403)
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
 def create_app():
     """Crea y configura la aplicación Flask.
     - Config simple y segura
@@ -46,6 +74,14 @@ def create_app():
     os.makedirs(app.instance_path, exist_ok=True)
     app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///" + os.path.join(app.instance_path, "app.db")
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    # Conexiones reutilizadas entre requests (los PRAGMA corren una vez por conexión);
+    # timeout = espera ante el lock de escritura en vez de fallar con "database is locked"
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "poolclass": QueuePool,
+        "pool_size": 5,
+        "pool_pre_ping": False,
+        "connect_args": {"check_same_thread": False, "timeout": 30},
+    }
 
     db.init_app(app)
     login_manager.init_app(app)
@@ -53,23 +89,14 @@ def create_app():
     csrf.init_app(app)
 
     app.jinja_env.globals.update(datetime=datetime)
+    # Compila todas las plantillas al arrancar (son pocas, caben en la caché de Jinja)
+    for nombre in app.jinja_env.list_templates():
+        app.jinja_env.get_template(nombre)
 
     @app.context_processor
     def inject_csrf_token():
         return dict(csrf_token=generate_csrf)
 
-    # ----- Permisos por rol -----
-    def roles_required(*roles):
-        """Permite acceder solo si el rol del usuario está en roles; si no, 403."""
-        def decorator(fn):
-            @wraps(fn)
-            def wrapper(*args, **kwargs):
-                if not current_user.is_authenticated or current_user.role not in roles:
-                    abort(403)
-                return fn(*args, **kwargs)
-            return wrapper
-        return decorator
-
     # =====================
     #       MODELOS
     # =====================
@@ -81,14 +108,26 @@ def create_app():
         role = db.Column(db.String(20), default="user")
 
         def set_password(self, raw_password: str):
-            self.password_hash = generate_password_hash(raw_password)
+            self.password_hash = ph.hash(raw_password)
 
         def check_password(self, raw_password: str) -> bool:
-            return check_password_hash(self.password_hash, raw_password)
+            """Verifica la clave; si el hash es antiguo (PBKDF2) o con otros parámetros, lo regenera."""
+            if not self.password_hash.startswith("$argon2"):
+                if not check_password_hash(self.password_hash, raw_password):
+                    return False
+                self.set_password(raw_password)
+                return True
+            try:
+                ph.verify(self.password_hash, raw_password)
+            except (VerifyMismatchError, InvalidHashError):
+                return False
+            if ph.check_needs_rehash(self.password_hash):
+                self.set_password(raw_password)
+            return True
 
     @login_manager.user_loader
     def load_user(user_id):
-        return User.query.get(int(user_id))
+        return db.session.get(User, int(user_id))
 
     class Cliente(db.Model):
         __tablename__ = "clientes"
@@ -97,7 +136,7 @@ def create_app():
         direccion = db.Column(db.String(200))
         telefono = db.Column(db.String(50))
         email = db.Column(db.String(120))
-        facturas = db.relationship("Factura", back_populates="cliente", lazy="dynamic")
+        facturas = db.relationship("Factura", back_populates="cliente")
 
         def __repr__(self):
             return f"<Cliente {self.id} - {self.nombre}>"
@@ -114,7 +153,7 @@ def create_app():
             db.CheckConstraint("stock >= 0", name="ck_producto_stock_nonneg"),
         )
 
-        detalles = db.relationship("DetalleFactura", back_populates="producto")
+        detalles = db.relationship("DetalleFactura", back_populates="producto", lazy="raise")
 
         def __repr__(self):
             return f"<Producto {self.id} - {self.descripcion} ${self.precio} stock:{self.stock}>"
@@ -128,6 +167,11 @@ def create_app():
         fecha = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
         total = db.Column(db.Numeric(12, 2), nullable=False, default=0)
 
+        __table_args__ = (
+            db.Index("ix_factura_cliente_fecha", "cliente_id", "fecha"),
+            db.Index("ix_factura_fecha", "fecha"),
+        )
+
         cliente = db.relationship("Cliente", back_populates="facturas")
         detalles = db.relationship(
             "DetalleFactura",
@@ -158,6 +202,8 @@ def create_app():
             db.CheckConstraint("cantidad > 0", name="ck_detalle_cantidad_pos"),
             db.CheckConstraint("precio_unitario >= 0", name="ck_detalle_pu_nonneg"),
             db.CheckConstraint("subtotal >= 0", name="ck_detalle_subtotal_nonneg"),
+            db.Index("ix_det_producto", "producto_id"),
+            db.Index("ix_det_factura", "factura_id"),
         )
 
         factura = db.relationship("Factura", back_populates="detalles")
@@ -205,6 +251,7 @@ def create_app():
             password = request.form.get("password", "")
             u = User.query.filter_by(email=email).first()
             if u and u.check_password(password):
+                db.session.commit()  # persiste un posible rehash
                 login_user(u)
                 return redirect(url_for("index"))
             flash("Credenciales inválidas", "error")
@@ -221,7 +268,12 @@ def create_app():
     @login_required
     @roles_required('admin')
     def clientes_list():
-        clientes = Cliente.query.order_by(Cliente.id.desc()).all()
+        clientes = (
+            Cliente.query
+            .with_entities(Cliente.id, Cliente.nombre, Cliente.email, Cliente.telefono)
+            .order_by(Cliente.id.desc())
+            .paginate(page=request.args.get("page", 1, type=int), per_page=50)
+        )
         return render_template("clientes/list.html", clientes=clientes)
 
     @app.route("/clientes/nuevo", methods=["GET", "POST"])
@@ -246,7 +298,7 @@ def create_app():
     @login_required
     @roles_required('admin')
     def clientes_editar(cliente_id):
-        cliente = Cliente.query.get_or_404(cliente_id)
+        cliente = db.session.get(Cliente, cliente_id) or abort(404)
         form = ClienteForm(obj=cliente)
         if form.validate_on_submit():
             cliente.nombre = form.nombre.data.strip()
@@ -262,8 +314,9 @@ def create_app():
     @login_required
     @roles_required('admin')
     def clientes_eliminar(cliente_id):
-        cliente = Cliente.query.get_or_404(cliente_id)
-        if cliente.facturas.count() > 0:
+        cliente = db.session.get(Cliente, cliente_id) or abort(404)
+        tiene_facturas = db.session.query(Factura.id).filter_by(cliente_id=cliente.id).limit(1).scalar()
+        if tiene_facturas is not None:
             flash("No se puede eliminar: el cliente tiene facturas asociadas.", "warning")
             return redirect(url_for("clientes_list"))
         db.session.delete(cliente)
@@ -275,20 +328,31 @@ def create_app():
     @app.route("/facturas/nueva", methods=["GET", "POST"])
     @login_required
     def facturas_nueva():
-        clientes = Cliente.query.order_by(Cliente.nombre.asc()).all()
-        productos = Producto.query.order_by(Producto.descripcion.asc()).all()
-
         ROWS = 5
         prev = {"cliente_id": request.form.get("cliente_id", type=int)}
         for i in range(1, ROWS + 1):
             prev[f"product_id_{i}"] = request.form.get(f"product_id_{i}", type=int)
             prev[f"cantidad_{i}"] = request.form.get(f"cantidad_{i}", type=int)
 
+        def render_form():
+            # Solo las columnas que usa la plantilla; se consulta únicamente al renderizar
+            clientes = (
+                db.session.query(Cliente.id, Cliente.nombre, Cliente.email)
+                .order_by(Cliente.nombre.asc())
+                .all()
+            )
+            productos = (
+                db.session.query(Producto.id, Producto.descripcion, Producto.precio, Producto.stock)
+                .order_by(Producto.descripcion.asc())
+                .all()
+            )
+            return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+
         if request.method == "POST":
             cliente_id = request.form.get("cliente_id", type=int)
             if not cliente_id:
                 flash("Selecciona un cliente.", "warning")
-                return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+                return render_form()
 
             items = []
             for i in range(1, ROWS + 1):
@@ -297,12 +361,12 @@ def create_app():
                 if pid and qty:
                     if qty <= 0:
                         flash("La cantidad debe ser mayor que 0.", "warning")
-                        return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+                        return render_form()
                     items.append((pid, qty))
 
             if not items:
                 flash("Agrega al menos un producto.", "warning")
-                return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+                return render_form()
 
             agg = {}
             for pid, qty in items:
@@ -313,45 +377,65 @@ def create_app():
             faltan = [pid for pid in agg if pid not in by_id]
             if faltan:
                 flash("Producto inexistente en la selección.", "warning")
-                return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
-
-            insuf = []
-            for pid, qty in agg.items():
-                p = by_id[pid]
-                stock = p.stock or 0
-                if qty > stock:
-                    insuf.append(f"{p.descripcion} (stock {stock}, pedido {qty})")
-            if insuf:
+                return render_form()
+
+            # Descuento atómico: solo se actualiza la fila si alcanza el stock (evita sobreventa concurrente)
+            productos_t = Producto.__table__
+            res = db.session.execute(
+                update(productos_t)
+                .where(productos_t.c.id == bindparam("pid"), productos_t.c.stock >= bindparam("qty"))
+                .values(stock=productos_t.c.stock - bindparam("qty")),
+                [{"pid": pid, "qty": qty} for pid, qty in agg.items()],
+            )
+            if res.rowcount != len(agg):
+                db.session.rollback()
+                insuf = []
+                for pid, qty in agg.items():
+                    p = by_id[pid]  # recargado tras el rollback
+                    stock = p.stock or 0
+                    if qty > stock:
+                        insuf.append(f"{p.descripcion} (stock {stock}, pedido {qty})")
                 flash("Stock insuficiente para: " + ", ".join(insuf), "warning")
-                return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+                return render_form()
 
             factura = Factura(cliente_id=cliente_id, fecha=datetime.utcnow(), total=Decimal("0"))
             db.session.add(factura)
+            db.session.flush()  # asigna factura.id
 
+            # Detalles en un solo executemany (misma transacción que el stock)
+            detalles = []
+            total = Decimal("0")
             for pid, qty in agg.items():
-                p = by_id[pid]
-                precio = p.precio or Decimal("0")
-                det = DetalleFactura(
-                    factura=factura,
-                    producto=p,
-                    cantidad=qty,
-                    precio_unitario=precio
-                )
-                det.calcular_subtotal()
-                db.session.add(det)
-                p.stock = (p.stock or 0) - qty
-
-            factura.recalcular_total()
+                precio = by_id[pid].precio or Decimal("0")
+                subtotal = precio * qty
+                detalles.append({
+                    "factura_id": factura.id,
+                    "producto_id": pid,
+                    "cantidad": qty,
+                    "precio_unitario": precio,
+                    "subtotal": subtotal,
+                })
+                total += subtotal
+            db.session.execute(insert(DetalleFactura), detalles)
+
+            factura.total = total
             db.session.commit()
             flash("Factura creada correctamente.", "success")
             return redirect(url_for("facturas_detalle", factura_id=factura.id))
 
-        return render_template("facturas/nueva.html", clientes=clientes, productos=productos, rows=ROWS, prev=prev)
+        return render_form()
 
     @app.route("/facturas/<int:factura_id>")
     @login_required
     def facturas_detalle(factura_id):
-        f = Factura.query.get_or_404(factura_id)
+        f = db.session.get(
+            Factura,
+            factura_id,
+            options=[
+                selectinload(Factura.detalles).joinedload(DetalleFactura.producto),
+                joinedload(Factura.cliente),
+            ],
+        ) or abort(404)
         return render_template("facturas/detalle.html", f=f)
 
     # ----- PRODUCTOS: listado / alta / edición / eliminación -----
@@ -359,7 +443,12 @@ def create_app():
     @login_required
     @roles_required('admin')
     def productos_list():
-        productos = Producto.query.order_by(Producto.id.desc()).all()
+        productos = (
+            Producto.query
+            .with_entities(Producto.id, Producto.descripcion, Producto.precio, Producto.stock)
+            .order_by(Producto.id.desc())
+            .paginate(page=request.args.get("page", 1, type=int), per_page=50)
+        )
         return render_template("productos/list.html", productos=productos)
 
     @app.route("/productos/nuevo", methods=["GET", "POST"])
@@ -383,7 +472,7 @@ def create_app():
     @login_required
     @roles_required('admin')
     def productos_editar(producto_id):
-        producto = Producto.query.get_or_404(producto_id)
+        producto = db.session.get(Producto, producto_id) or abort(404)
         form = ProductoForm(obj=producto)
         if form.validate_on_submit():
             producto.descripcion = form.descripcion.data.strip()
@@ -398,8 +487,9 @@ def create_app():
     @login_required
     @roles_required('admin')
     def productos_eliminar(producto_id):
-        producto = Producto.query.get_or_404(producto_id)
-        if producto.detalles and len(producto.detalles) > 0:
+        producto = db.session.get(Producto, producto_id) or abort(404)
+        usado = db.session.query(DetalleFactura.id).filter_by(producto_id=producto.id).first() is not None
+        if usado:
             flash("No se puede eliminar: el producto está usado en facturas.", "warning")
             return redirect(url_for("productos_list"))
         db.session.delete(producto)
@@ -426,7 +516,7 @@ def create_app():
         desde_dt = _parse_date_yyyy_mm_dd(desde_str)
         hasta_dt = _parse_date_yyyy_mm_dd(hasta_str)
 
-        q = Factura.query
+        q = Factura.query.options(selectinload(Factura.cliente))
         if cliente_id:
             q = q.filter(Factura.cliente_id == cliente_id)
         if desde_dt:
@@ -455,16 +545,24 @@ def create_app():
         desde_dt = _parse_date_yyyy_mm_dd(desde_str)
         hasta_dt = _parse_date_yyyy_mm_dd(hasta_str)
 
-        q = Factura.query
+        where_clauses = []
         if desde_dt:
-            q = q.filter(Factura.fecha >= desde_dt)
+            where_clauses.append(Factura.fecha >= desde_dt)
         if hasta_dt:
             fin_dia = hasta_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
-            q = q.filter(Factura.fecha <= fin_dia)
+            where_clauses.append(Factura.fecha <= fin_dia)
 
-        facturas = q.order_by(Factura.fecha.desc(), Factura.id.desc()).all()
-        total = sum((f.total or Decimal("0")) for f in facturas)
-        conteo = len(facturas)
+        total, conteo = (
+            db.session.query(func.coalesce(func.sum(Factura.total), 0), func.count(Factura.id))
+            .filter(*where_clauses)
+            .one()
+        )
+        facturas = (
+            Factura.query.options(selectinload(Factura.cliente))
+            .filter(*where_clauses)
+            .order_by(Factura.fecha.desc(), Factura.id.desc())
+            .all()
+        )
         filtros = {"desde": desde_str or "", "hasta": hasta_str or ""}
         return render_template("reportes/ventas.html", facturas=facturas, total=total, conteo=conteo, filtros=filtros)
 
@@ -483,14 +581,23 @@ def create_app():
         facturas = []
         total = Decimal("0")
         if cliente_id:
-            q = Factura.query.filter(Factura.cliente_id == cliente_id)
+            where_clauses = [Factura.cliente_id == cliente_id]
             if desde_dt:
-                q = q.filter(Factura.fecha >= desde_dt)
+                where_clauses.append(Factura.fecha >= desde_dt)
             if hasta_dt:
                 fin_dia = hasta_dt.replace(hour=23, minute=59, second=59, microsecond=999999)
-                q = q.filter(Factura.fecha <= fin_dia)
-            facturas = q.order_by(Factura.fecha.desc(), Factura.id.desc()).all()
-            total = sum((f.total or Decimal("0")) for f in facturas)
+                where_clauses.append(Factura.fecha <= fin_dia)
+            total = (
+                db.session.query(func.coalesce(func.sum(Factura.total), 0))
+                .filter(*where_clauses)
+                .scalar()
+            )
+            facturas = (
+                Factura.query
+                .filter(*where_clauses)
+                .order_by(Factura.fecha.desc(), Factura.id.desc())
+                .all()
+            )
 
         filtros = {"cliente_id": cliente_id, "desde": desde_str or "", "hasta": hasta_str or ""}
         return render_template("reportes/facturas_clientes.html", clientes=clientes, facturas=facturas, total=total, filtros=filtros)
@@ -513,19 +620,29 @@ def create_app():
     # =====================
     with app.app_context():
         db.create_all()
+        # create_all no agrega índices a tablas ya existentes
+        for model in (Factura, DetalleFactura):
+            for idx in model.__table__.indexes:
+                idx.create(db.engine, checkfirst=True)
+
+        # Un solo SELECT para saber qué falta sembrar; las claves demo (hash costoso) solo en el primer arranque
+        hay_usuarios, hay_clientes, hay_productos = db.session.execute(
+            select(
+                select(User.id).exists(),
+                select(Cliente.id).exists(),
+                select(Producto.id).exists(),
+            )
+        ).one()
 
-        if not User.query.filter_by(email="administrador@facturas.com").first():
+        if not hay_usuarios:
             admin = User(email="administrador@facturas.com", role="admin")
             admin.set_password("admin")
-            db.session.add(admin)
-        if not User.query.filter_by(email="usuario@facturas.com").first():
             user = User(email="usuario@facturas.com", role="user")
             user.set_password("user")
-            db.session.add(user)
-
-        if not Cliente.query.first():
+            db.session.add_all([admin, user])
+        if not hay_clientes:
             db.session.add(Cliente(nombre="Cliente demo", email="cliente@demo.com"))
-        if not Producto.query.first():
+        if not hay_productos:
             db.session.add(Producto(descripcion="Producto demo", precio=Decimal("100.00"), stock=10))
 
         db.session.commit()